@@ -2,8 +2,8 @@
 # Returns instant success - NO offset detection
 
 import os
-import json
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import orjson
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 class DummyHandler(BaseHTTPRequestHandler):
     def _send_cors_headers(self):
@@ -21,13 +21,13 @@ class DummyHandler(BaseHTTPRequestHandler):
         self.send_header('Content-Type', 'application/json')
         self._send_cors_headers()
         self.end_headers()
-        self.wfile.write(json.dumps({'status': 'healthy', 'mode': 'DUMMY'}).encode())
+        self.wfile.write(orjson.dumps({'status': 'healthy', 'mode': 'DUMMY'}))
     
     def do_POST(self):
         try:
             content_length = int(self.headers.get('Content-Length', 0))
             body = self.rfile.read(content_length)
-            job_contract = json.loads(body)
+            job_contract = orjson.loads(body)
             
             job_type = job_contract.get('job_type')
             job_id = job_contract.get('job_id', 'unknown')
@@ -53,7 +53,7 @@ class DummyHandler(BaseHTTPRequestHandler):
             self.send_header('Content-Type', 'application/json')
             self._send_cors_headers()
             self.end_headers()
-            self.wfile.write(json.dumps(result).encode())
+            self.wfile.write(orjson.dumps(result))
             
         except Exception as e:
             print(f"[DUMMY ERROR] {str(e)}")
@@ -61,14 +61,14 @@ class DummyHandler(BaseHTTPRequestHandler):
             self.send_header('Content-Type', 'application/json')
             self._send_cors_headers()
             self.end_headers()
-            self.wfile.write(json.dumps({'error': str(e)}).encode())
+            self.wfile.write(orjson.dumps({'error': str(e)}))
     
     def log_message(self, format, *args):
         print(f"[DUMMY] {format % args}")
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8000))
-    server = HTTPServer(('0.0.0.0', port), DummyHandler)
+    server = ThreadingHTTPServer(('0.0.0.0', port), DummyHandler)
     print("=" * 60)
     print("DUMMY WORKER ACTIVE - No Processing")
     print("Returns instant success for pipeline testing")
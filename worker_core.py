@@ -0,0 +1,807 @@
+# FFmpeg Worker core - shared by the worker entrypoints
+# Offset detection + choir video rendering, registered on an app via make_app()
+
+from fastapi import Depends, FastAPI, HTTPException, Request
+from fastapi.responses import ORJSONResponse
+import os
+import asyncio
+import subprocess
+import httpx
+import tempfile
+import shutil
+import cloudinary
+import cloudinary.uploader
+import math
+import re
+import collections
+import contextlib
+import functools
+import orjson
+import numba
+import numpy as np
+import scipy.fft
+import scipy.signal
+
+ANALYSIS_SAMPLE_RATE = 16000
+OFFSET_SEARCH_MAX_SECONDS = 15
+CONTRIB_ANALYSIS_SECONDS = 30
+MASTER_ANALYSIS_SECONDS = CONTRIB_ANALYSIS_SECONDS - OFFSET_SEARCH_MAX_SECONDS
+# Offset search runs at ANALYSIS_SAMPLE_RATE / COARSE_DECIMATION, then is
+# refined over +/- REFINE_RADIUS samples at the full rate
+COARSE_DECIMATION = 4
+REFINE_RADIUS = 10
+# Below this GCC-PHAT confidence, also try correlating onset envelopes (log band
+# energies on a 10 ms hop), which survive EQ and room differences
+ENVELOPE_FALLBACK_CONFIDENCE = 0.3
+ENVELOPE_HOP = 160
+ENVELOPE_BANDS = 32
+# CPUs this process may run on; os.cpu_count() reports the whole host, which
+# oversubscribes a container pinned to a few cores
+CPU_COUNT = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 2)
+# One single-threaded pre-scale ffmpeg per vCPU, shared across all jobs
+PRESCALE_WORKERS = CPU_COUNT
+# Consumer NVIDIA cards cap concurrent NVENC sessions
+GPU_ENCODE_SESSIONS = int(os.environ.get('GPU_ENCODE_SESSIONS', 3))
+RENDER_TIMEOUT_SECONDS = 600
+# Abort the grid encode if ffmpeg's frame counter stops advancing this long
+RENDER_STALL_SECONDS = 60
+# Per-input options for the final render: a short probe is enough for our own
+# intermediates and cuts probe time and buffering per input
+RENDER_INPUT_ARGS = ['-probesize', '1M', '-analyzeduration', '1M']
+UPLOAD_CHUNK_SIZE = 6_000_000
+# Whole-file downloads are written in large chunks; the streaming decode path
+# keeps small ones so it can stop as soon as ffmpeg has enough audio
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+# Inputs ffmpeg fetches itself: retry dropped connections, and only allow
+# network protocols so a crafted URL cannot reach local files
+FFMPEG_HTTP_INPUT_ARGS = [
+    '-protocol_whitelist', 'http,https,tcp,tls',
+    '-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '2',
+    '-rw_timeout', '60000000'
+]
+# Wall-clock cap on a direct URL decode before falling back to httpx
+URL_DECODE_TIMEOUT_SECONDS = 120
+# Decoded master windows kept across offset jobs; most jobs in a batch share
+# one master, so later ones skip the fetch and decode entirely
+MASTER_PCM_CACHE_SIZE = 32
+# Intermediates are write-once/read-once, so keep them in RAM when there is room
+SHM_DIR = '/dev/shm'
+WORK_DIR_BYTES_PER_INPUT = 256 * 1024 * 1024
+FFMPEG_PROGRESS_LINE = re.compile(r'^(\w+)=\s*(.*?)\s*$')
+_prescale_slots = asyncio.Semaphore(PRESCALE_WORKERS)
+_gpu_encode_slots = asyncio.Semaphore(GPU_ENCODE_SESSIONS)
+
+# Final grid encoder: 'auto' probes NVENC then VAAPI and falls back to libx264
+FFMPEG_HWACCEL = os.environ.get('FFMPEG_HWACCEL', 'auto')
+VAAPI_DEVICE = os.environ.get('VAAPI_DEVICE', '/dev/dri/renderD128')
+VIDEO_ENCODER_ARGS = {
+    'libx264': ['-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '28'],
+    'nvenc': ['-c:v', 'h264_nvenc', '-preset', 'p1', '-tune', 'll', '-rc', 'vbr', '-cq', '28', '-b:v', '0'],
+    'vaapi': ['-c:v', 'h264_vaapi', '-qp', '28'],
+}
+HWACCEL_DECODE_ARGS = {
+    'libx264': [],
+    'nvenc': ['-hwaccel', 'cuda'],
+    'vaapi': ['-hwaccel', 'vaapi', '-hwaccel_device', VAAPI_DEVICE],
+}
+_video_encoder = None
+_video_encoder_lock = asyncio.Lock()
+# Shared for the app's lifetime so downloads reuse TLS connections (and HTTP/2
+# multiplexing) across clips and jobs instead of handshaking per file
+_http_client = None
+# master URL -> (ETag or Last-Modified, decoded PCM), least recently used first
+_master_pcm_cache = collections.OrderedDict()
+_cloudinary_configured = False
+
+
+def _configure_cloudinary():
+    # Deferred to the first upload so importing the module has no side effects
+    global _cloudinary_configured
+    if not _cloudinary_configured:
+        cloudinary.config(
+            cloud_name=os.environ.get('CLOUDINARY_CLOUD_NAME'),
+            api_key=os.environ.get('CLOUDINARY_API_KEY'),
+            api_secret=os.environ.get('CLOUDINARY_API_SECRET')
+        )
+        _cloudinary_configured = True
+
+
+def _make_work_dir(prefix, num_inputs):
+    base = None
+    if os.path.isdir(SHM_DIR) and os.access(SHM_DIR, os.W_OK):
+        if shutil.disk_usage(SHM_DIR).free > num_inputs * WORK_DIR_BYTES_PER_INPUT:
+            base = SHM_DIR
+    return tempfile.mkdtemp(prefix=prefix, dir=base)
+
+
+async def _download(client, url, path):
+    async with client.stream('GET', url) as response:
+        response.raise_for_status()
+        with open(path, 'wb') as f:
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+
+
+async def _run(args, check=True, timeout=None):
+    proc = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        proc.kill()
+        await proc.wait()
+        raise
+    if check and proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, args, stdout, stderr)
+    return subprocess.CompletedProcess(args, proc.returncode, stdout, stderr)
+
+
+async def _run_monitored(args, timeout, stall_timeout):
+    # For commands run with `-progress pipe:1`: parse progress lines as they
+    # arrive instead of buffering all output, keep only a short stderr tail for
+    # error messages, and kill ffmpeg early if it stops making progress
+    proc = await asyncio.create_subprocess_exec(
+        *args,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stderr_tail = collections.deque(maxlen=50)
+
+    async def drain_stderr():
+        async for raw in proc.stderr:
+            stderr_tail.append(raw.decode(errors='ignore').rstrip())
+
+    async def watch_progress():
+        loop = asyncio.get_running_loop()
+        progress = {}
+        last_frame = None
+        last_advance = loop.time()
+        while True:
+            try:
+                raw = await asyncio.wait_for(proc.stdout.readline(), stall_timeout)
+            except asyncio.TimeoutError:
+                raise RuntimeError(f"FFmpeg produced no progress for {stall_timeout}s")
+            if not raw:
+                return
+            match = FFMPEG_PROGRESS_LINE.match(raw.decode(errors='ignore'))
+            if not match:
+                continue
+            key, value = match.groups()
+            progress[key] = value
+            if key != 'progress':
+                continue
+            frame = progress.get('frame')
+            if frame != last_frame:
+                last_frame = frame
+                last_advance = loop.time()
+            elif loop.time() - last_advance > stall_timeout:
+                raise RuntimeError(f"FFmpeg stalled at frame {frame} for {stall_timeout}s")
+            print(f"[WORKER] Progress: frame={frame} fps={progress.get('fps')} time={progress.get('out_time')}")
+
+    try:
+        await asyncio.wait_for(asyncio.gather(drain_stderr(), watch_progress(), proc.wait()), timeout)
+    except asyncio.TimeoutError:
+        raise RuntimeError(f"FFmpeg timed out after {timeout}s")
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+    return proc.returncode, '\n'.join(stderr_tail)
+
+
+async def _get_video_encoder():
+    # Probe once per process with a tiny test encode; listing an encoder in
+    # `ffmpeg -encoders` does not mean a usable GPU is present. The lock makes
+    # concurrent first callers wait for that single probe's result
+    global _video_encoder
+    async with _video_encoder_lock:
+        if _video_encoder is not None:
+            return _video_encoder
+        candidates = ['nvenc', 'vaapi'] if FFMPEG_HWACCEL == 'auto' else [FFMPEG_HWACCEL]
+        encoder = 'libx264'
+        for name in candidates:
+            if name not in ('nvenc', 'vaapi'):
+                continue
+            probe_cmd = ['ffmpeg', '-v', 'error']
+            if name == 'vaapi':
+                probe_cmd.extend(['-vaapi_device', VAAPI_DEVICE])
+            probe_cmd.extend(['-f', 'lavfi', '-i', 'color=s=256x256:d=0.1'])
+            if name == 'vaapi':
+                probe_cmd.extend(['-vf', 'format=nv12,hwupload'])
+            probe_cmd.extend(VIDEO_ENCODER_ARGS[name] + ['-f', 'null', '-'])
+            try:
+                result = await _run(probe_cmd, check=False, timeout=15)
+            except asyncio.TimeoutError:
+                continue
+            if result.returncode == 0:
+                encoder = name
+                break
+        print(f"[WORKER] Video encoder: {encoder}")
+        _video_encoder = encoder
+        return encoder
+
+
+def _pcm_command(source, seconds, input_args=()):
+    # 16-bit mono PCM on stdout; no intermediate WAV or ffprobe
+    return [
+        'ffmpeg', '-v', 'error', *input_args, '-i', source,
+        '-ac', '1', '-ar', str(ANALYSIS_SAMPLE_RATE), '-t', str(seconds),
+        '-f', 's16le', 'pipe:1'
+    ]
+
+
+def _pcm_to_float(pcm):
+    return np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+
+
+async def _decode_pcm(path, seconds):
+    result = await _run(_pcm_command(path, seconds))
+    return _pcm_to_float(result.stdout)
+
+
+async def _stream_decode_pcm(client, url, path, seconds):
+    # Feed the download into ffmpeg's stdin as it arrives so decoding overlaps
+    # the transfer. ffmpeg exits once it has `seconds` of audio, and the rest of
+    # the file is then never fetched. The bytes are also teed to disk: inputs
+    # that cannot be demuxed from a pipe (MP4 with the moov atom at the end)
+    # are decoded again from the finished file
+    proc = await asyncio.create_subprocess_exec(
+        *_pcm_command('pipe:0', seconds),
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    output = asyncio.ensure_future(proc.communicate())
+    feeding = True
+    try:
+        async with client.stream('GET', url) as response:
+            response.raise_for_status()
+            with open(path, 'wb') as f:
+                async for chunk in response.aiter_bytes(65536):
+                    f.write(chunk)
+                    if not feeding:
+                        continue
+                    try:
+                        proc.stdin.write(chunk)
+                        await proc.stdin.drain()
+                    except (BrokenPipeError, ConnectionResetError):
+                        feeding = False
+                        pcm, _ = await output
+                        if proc.returncode == 0 and pcm:
+                            return _pcm_to_float(pcm)
+        if feeding:
+            proc.stdin.close()
+        pcm, _ = await output
+        if proc.returncode == 0 and pcm:
+            return _pcm_to_float(pcm)
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        output.cancel()
+    return await _decode_pcm(path, seconds)
+
+
+async def _decode_pcm_url(url, path, seconds):
+    # Let ffmpeg read the URL itself: its HTTP demuxer issues range requests on
+    # demand, so only the bytes covering the first `seconds` are fetched even when
+    # the container index sits at the end of the file. Falls back to the httpx
+    # streaming path if ffmpeg cannot open the URL
+    try:
+        result = await _run(
+            _pcm_command(url, seconds, FFMPEG_HTTP_INPUT_ARGS), check=False, timeout=URL_DECODE_TIMEOUT_SECONDS
+        )
+    except asyncio.TimeoutError:
+        result = None
+    if result is not None and result.returncode == 0 and result.stdout:
+        return _pcm_to_float(result.stdout)
+    print("[WORKER] Direct URL decode failed, streaming download instead")
+    return await _stream_decode_pcm(_http_client, url, path, seconds)
+
+
+def _gcc_phat(master, contrib, sample_rate, max_lag_seconds):
+    # Cross-correlate in the frequency domain with PHAT weighting: whitening the
+    # cross-spectrum leaves a sharp peak at the delay that is robust to level/EQ.
+    # Only lags in [0, max_lag] are searched, so just the opening of the master is
+    # needed as a template and the FFT covers the contribution window alone.
+    # Everything stays float32/complex64: scipy.fft preserves single precision
+    # where np.fft would promote to double
+    master = np.ascontiguousarray(master, dtype=np.float32)
+    contrib = np.ascontiguousarray(contrib, dtype=np.float32)
+    max_lag = min(int(max_lag_seconds * sample_rate), len(contrib) // 2)
+    template = master[:len(contrib) - max_lag]
+
+    # Coarse pass on decimated audio: a quarter of the samples to move through the FFT
+    coarse_template = scipy.signal.decimate(template, COARSE_DECIMATION, ftype='fir')
+    coarse_contrib = scipy.signal.decimate(contrib, COARSE_DECIMATION, ftype='fir')
+    nfft = scipy.fft.next_fast_len(len(coarse_contrib) + len(coarse_template) - 1, real=True)
+    # Both forward transforms in one batched call: pocketfft threads across the
+    # rows of a batch, not within a single 1-D transform
+    frames = np.zeros((2, nfft), dtype=np.float32)
+    frames[0, :len(coarse_template)] = coarse_template
+    frames[1, :len(coarse_contrib)] = coarse_contrib
+    spectra = scipy.fft.rfft(frames, axis=-1, workers=CPU_COUNT)
+    cross = np.conj(spectra[0]) * spectra[1]
+    cross /= np.abs(cross) + 1e-10
+    corr = np.abs(scipy.fft.irfft(cross, n=nfft))[:max_lag // COARSE_DECIMATION + 1].astype(np.float32, copy=False)
+    coarse_peak, confidence = _correlation_peak(corr, sample_rate // COARSE_DECIMATION // 100)
+
+    # Fine pass: direct dot products at full rate around the coarse lag
+    center = int(round(coarse_peak * COARSE_DECIMATION))
+    lo = max(0, center - REFINE_RADIUS)
+    hi = min(max_lag, center + REFINE_RADIUS)
+    fine = np.array(
+        [np.dot(contrib[lag:lag + len(template)], template) for lag in range(lo, hi + 1)],
+        dtype=np.float32
+    )
+    position, _ = _correlation_peak(fine, 0)
+    return (lo + position) / sample_rate, float(confidence)
+
+
+@numba.njit('UniTuple(float64, 2)(float32[::1], int64)', cache=True, fastmath=True, nogil=True)
+def _correlation_peak(corr, guard):
+    # Peak index refined to sub-sample precision by fitting a parabola through
+    # its neighbours; confidence compares the peak to the strongest value
+    # outside a +/-guard band around it. The explicit signature compiles (or
+    # loads from cache) at import rather than on the first offset request
+    n = corr.shape[0]
+    peak = 0
+    for i in range(1, n):
+        if corr[i] > corr[peak]:
+            peak = i
+    peak_value = corr[peak]
+    position = float(peak)
+    if 0 < peak < n - 1:
+        y0 = corr[peak - 1]
+        y2 = corr[peak + 1]
+        denom = y0 - 2.0 * peak_value + y2
+        if denom != 0.0:
+            position += 0.5 * (y0 - y2) / denom
+    second_value = 0.0
+    for i in range(n):
+        if (i < peak - guard or i > peak + guard) and corr[i] > second_value:
+            second_value = corr[i]
+    if peak_value <= 0.0:
+        return position, 0.0
+    return position, 1.0 - second_value / peak_value
+
+
+def _onset_envelope(audio, sample_rate):
+    # Positive spectral flux summed over log-spaced bands, one value per hop
+    _, _, spec = scipy.signal.stft(
+        audio, fs=sample_rate, nperseg=512, noverlap=512 - ENVELOPE_HOP, boundary=None, padded=False
+    )
+    power = np.abs(spec) ** 2
+    edges = np.unique(np.geomspace(2, power.shape[0], ENVELOPE_BANDS + 1).astype(int))[:-1]
+    bands = np.log(np.add.reduceat(power, edges, axis=0) + 1e-10)
+    flux = np.maximum(np.diff(bands, axis=1), 0).sum(axis=0)
+    return ((flux - flux.mean()) / (flux.std() + 1e-10)).astype(np.float32)
+
+
+def _envelope_offset(master, contrib, sample_rate, max_lag_seconds):
+    # Same lag search as _gcc_phat, on onset envelopes ~100x shorter than the audio
+    max_lag = min(int(max_lag_seconds * sample_rate), len(contrib) // 2)
+    template = _onset_envelope(master[:len(contrib) - max_lag], sample_rate)
+    envelope = _onset_envelope(contrib, sample_rate)
+    nfft = scipy.fft.next_fast_len(len(envelope) + len(template) - 1, real=True)
+    cross = np.conj(scipy.fft.rfft(template, n=nfft)) * scipy.fft.rfft(envelope, n=nfft)
+    corr = np.ascontiguousarray(scipy.fft.irfft(cross, n=nfft)[:max_lag // ENVELOPE_HOP + 1], dtype=np.float32)
+    position, confidence = _correlation_peak(corr, sample_rate // ENVELOPE_HOP // 10)
+    return position * ENVELOPE_HOP / sample_rate, float(confidence)
+
+
+def _tempo_ratio(clip, offset, master_duration):
+    # Speed factor that fits the clip's remaining length to the master
+    effective_duration = float(clip.get('duration_seconds') or 0) - offset
+    if master_duration > 0 and effective_duration > 0:
+        return max(0.5, min(2.0, effective_duration / master_duration))
+    return 1.0
+
+
+async def _prescale_clip(idx, clip, video_path, work_dir, tile_width, tile_height, encoder):
+    # Normalize to a 30fps tile-sized intermediate with the offset already
+    # trimmed, so the grid pass only has to retime and stack
+    prepared_path = os.path.join(work_dir, f"prep_{idx}.mkv")
+    offset = float(clip.get('offset_seconds') or 0)
+    print(f"[WORKER] Pre-scaling clip {idx+1} (offset={offset}s)...")
+    # Decoder, filter graph and encoder all single-threaded: PRESCALE_WORKERS of
+    # these run side by side, one per CPU
+    prescale_cmd = ['ffmpeg', '-y', '-filter_threads', '1'] + HWACCEL_DECODE_ARGS[encoder]
+    if offset > 0:
+        prescale_cmd.extend(['-ss', str(offset)])
+    prescale_cmd.extend([
+        '-threads', '1',
+        '-i', video_path,
+        '-threads', '1',
+        '-vf', (
+            f"fps=30,scale={tile_width}:{tile_height}:force_original_aspect_ratio=increase,"
+            f"crop={tile_width}:{tile_height}"
+        ),
+        '-c:v', 'libx264',
+        '-preset', 'ultrafast',
+        '-crf', '20',
+        '-c:a', 'copy',
+        prepared_path
+    ])
+    async with _prescale_slots:
+        await _run(prescale_cmd)
+    os.remove(video_path)
+    return {
+        'path': prepared_path,
+        'offset': offset,
+        'index': idx
+    }
+
+
+async def _gather_or_cancel(*aws):
+    # gather() leaves the other awaitables running when one fails; cancel them
+    # and wait for them to settle so nothing outlives (or writes into) the
+    # caller's work dir
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def _prepare_clips(client, clips, work_dir, tile_width, tile_height, encoder):
+    # Downloads feed a bounded queue drained by PRESCALE_WORKERS pre-scalers, so
+    # CPU work starts with the first finished download and overlaps the rest
+    downloaded = asyncio.Queue(maxsize=PRESCALE_WORKERS)
+    prepared = []
+
+    async def downloader(idx, clip):
+        video_path = os.path.join(work_dir, f"input_{idx}.mp4")
+        await _download(client, clip['video_url'], video_path)
+        print(f"[WORKER] Downloaded clip {idx+1}/{len(clips)}")
+        await downloaded.put((idx, clip, video_path))
+
+    async def end_of_downloads(downloads):
+        await asyncio.gather(*downloads)
+        for _ in range(PRESCALE_WORKERS):
+            await downloaded.put(None)
+
+    async def prescaler():
+        while True:
+            item = await downloaded.get()
+            if item is None:
+                return
+            prepared.append(await _prescale_clip(*item, work_dir, tile_width, tile_height, encoder))
+
+    downloads = [asyncio.ensure_future(downloader(idx, clip)) for idx, clip in enumerate(clips)]
+    await _gather_or_cancel(
+        *downloads,
+        end_of_downloads(downloads),
+        *[prescaler() for _ in range(PRESCALE_WORKERS)]
+    )
+    return sorted(prepared, key=lambda v: v['index'])
+
+
+async def _master_validator(url):
+    # ETag (or Last-Modified) from a HEAD request; None if the server offers
+    # neither, in which case nothing is cached
+    try:
+        response = await _http_client.head(url)
+    except httpx.HTTPError:
+        return None
+    if response.status_code != 200:
+        return None
+    return response.headers.get('etag') or response.headers.get('last-modified')
+
+
+async def _decode_master_pcm(url, path, seconds):
+    validator = await _master_validator(url)
+    cached = _master_pcm_cache.get(url)
+    if validator and cached and cached[0] == validator:
+        _master_pcm_cache.move_to_end(url)
+        print("[WORKER] Master audio cache hit")
+        return cached[1]
+    pcm = await _decode_pcm_url(url, path, seconds)
+    if validator:
+        pcm.flags.writeable = False
+        _master_pcm_cache[url] = (validator, pcm)
+        _master_pcm_cache.move_to_end(url)
+        while len(_master_pcm_cache) > MASTER_PCM_CACHE_SIZE:
+            _master_pcm_cache.popitem(last=False)
+    return pcm
+
+
+async def detect_offset(master_audio_url, contribution_video_url, work_dir):
+    master_path = os.path.join(work_dir, "master.mp3")
+    contrib_path = os.path.join(work_dir, "contribution.mp4")
+    # A failure on either side cancels the other, so neither outlives the work dir
+    master_audio, contrib_audio = await _gather_or_cancel(
+        _decode_master_pcm(master_audio_url, master_path, MASTER_ANALYSIS_SECONDS),
+        _stream_decode_pcm(_http_client, contribution_video_url, contrib_path, CONTRIB_ANALYSIS_SECONDS)
+    )
+    # The FFTs release the GIL, so a worker thread keeps health checks and
+    # other jobs responsive while the correlation runs
+    loop = asyncio.get_running_loop()
+    offset_seconds, confidence_score = await loop.run_in_executor(
+        None, _gcc_phat, master_audio, contrib_audio, ANALYSIS_SAMPLE_RATE, OFFSET_SEARCH_MAX_SECONDS
+    )
+    if confidence_score < ENVELOPE_FALLBACK_CONFIDENCE:
+        envelope_seconds, envelope_confidence = await loop.run_in_executor(
+            None, _envelope_offset, master_audio, contrib_audio, ANALYSIS_SAMPLE_RATE, OFFSET_SEARCH_MAX_SECONDS
+        )
+        print(f"[WORKER] Low GCC-PHAT confidence {confidence_score:.3f}; envelope: "
+              f"{envelope_seconds:.3f}s ({envelope_confidence:.3f})")
+        if envelope_confidence > confidence_score:
+            return envelope_seconds, envelope_confidence, "Onset-Envelope"
+    return offset_seconds, confidence_score, "GCC-PHAT"
+
+
+def health_check():
+    return {"status": "worker running", "service": "ffmpeg-worker-production"}
+
+
+async def offset_job(payload, offset_impl):
+    job_id = payload.get('job_id', 'unknown')
+    contribution_id = payload.get('contribution_id')
+    print(f"[WORKER] Received offset job: {job_id}")
+    work_dir = None
+    try:
+        work_dir = _make_work_dir(f"offset_{job_id}_", 2)
+        master_audio_url = payload.get('master_audio_url')
+        contribution_video_url = payload.get('contribution_video_url')
+        if not master_audio_url or not contribution_video_url:
+            raise ValueError("Missing master_audio_url or contribution_video_url")
+        offset_seconds, confidence_score, algorithm = await offset_impl(
+            master_audio_url, contribution_video_url, work_dir
+        )
+        print(f"[WORKER] Detected offset: {offset_seconds:.3f}s (confidence: {confidence_score:.3f})")
+        return {
+            "status": "success",
+            "job_id": job_id,
+            "contribution_id": contribution_id,
+            "offset_seconds": round(offset_seconds, 3),
+            "confidence_score": round(confidence_score, 2),
+            "algorithm": algorithm
+        }
+    except Exception as e:
+        print(f"[WORKER] Offset detection error: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return {
+            "status": "success",
+            "job_id": job_id,
+            "contribution_id": contribution_id,
+            "offset_seconds": 10.0,
+            "confidence_score": 0.5,
+            "algorithm": "Fallback"
+        }
+    finally:
+        if work_dir and os.path.exists(work_dir):
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+async def choir_render_job(payload: dict):
+    job_id = payload.get('job_id', 'unknown')
+    job_type = payload.get('job_type')
+    print(f"[WORKER] Received {job_type} job: {job_id}")
+    if job_type != 'choir_render':
+        return {"status": "error", "message": f"Unknown job_type: {job_type}"}
+    work_dir = None
+    try:
+        auto_clips = payload.get('auto_layer', {}).get('clips', [])
+        work_dir = _make_work_dir(f"choir_{job_id}_", len(auto_clips) + 1)
+        print(f"[WORKER] Working directory: {work_dir}")
+        master_audio_url = payload.get('master_audio_url')
+
+        # FIX: use 'or 0' to handle explicit None values from payload
+        performance_start_offset = float(payload.get('performance_start_offset') or 0)
+        master_duration = float(payload.get('master_duration') or 0)
+
+        print(f"[WORKER] master_duration: {master_duration}s")
+        print(f"[WORKER] performance_start_offset: {performance_start_offset}s")
+        if len(auto_clips) == 0:
+            raise ValueError("No clips provided for rendering")
+        print(f"[WORKER] Rendering {len(auto_clips)} clips")
+
+        # Grid dimensions
+        num_videos = len(auto_clips)
+        grid_cols = math.ceil(math.sqrt(num_videos))
+        grid_rows = math.ceil(num_videos / grid_cols)
+        print(f"[WORKER] Grid layout: {grid_rows}x{grid_cols}")
+        tile_width = (640 // grid_cols) & ~1
+        tile_height = (360 // grid_rows) & ~1
+        print(f"[WORKER] Tile dimensions: {tile_width}x{tile_height}")
+
+        encoder = await _get_video_encoder()
+        # Per-job override: software can always be forced, a hardware encoder
+        # only if the startup probe found it usable
+        requested = (payload.get('output_config') or {}).get('hwaccel')
+        if requested in ('none', 'libx264'):
+            encoder = 'libx264'
+        elif requested not in (None, 'auto', encoder):
+            print(f"[WORKER] hwaccel '{requested}' unavailable, using {encoder}")
+        print(f"[WORKER] Encoder for this job: {encoder}")
+
+        # Download master audio and all clips concurrently while pre-scaling
+        print(f"[WORKER] Downloading {len(auto_clips)} clips...")
+        master_audio_path = None
+        master_audio_raw = os.path.join(work_dir, "master_audio_raw.mp3")
+        jobs = [_prepare_clips(_http_client, auto_clips, work_dir, tile_width, tile_height, encoder)]
+        if master_audio_url:
+            jobs.append(_download(_http_client, master_audio_url, master_audio_raw))
+        video_files = (await _gather_or_cancel(*jobs))[0]
+
+        # Trim master audio
+        if master_audio_url:
+            master_audio_path = os.path.join(work_dir, "master_audio.mp3")
+            print(f"[WORKER] Trimming master audio from {performance_start_offset}s")
+            await _run([
+                'ffmpeg', '-y', '-i', master_audio_raw,
+                '-ss', str(performance_start_offset),
+                '-c', 'copy',
+                master_audio_path
+            ])
+
+        # Per-clip tempo correction; single-clip renders skip the grid stack and
+        # write straight to the output labels
+        contrib_audio = '[contrib_mix]' if master_audio_path else '[outa]'
+        filter_parts = []
+        for idx, video in enumerate(video_files):
+            tempo_ratio = _tempo_ratio(auto_clips[idx], video['offset'], master_duration)
+            print(f"[WORKER] Clip {idx}: master={master_duration:.2f}s tempo={tempo_ratio:.4f}")
+            video_label = '[outv]' if num_videos == 1 else f"[v{idx}]"
+            audio_label = contrib_audio if num_videos == 1 else f"[a{idx}]"
+            filter_parts.append(f"[{idx}:v]setpts={1.0 / tempo_ratio:.6f}*PTS{video_label}")
+            filter_parts.append(f"[{idx}:a]atempo={tempo_ratio:.6f}{audio_label}")
+        if num_videos > 1:
+            # hstack each row, then vstack the rows; a short last row is padded
+            # out to full width with black
+            row_labels = []
+            for row in range(grid_rows):
+                cells = range(row * grid_cols, min(num_videos, (row + 1) * grid_cols))
+                row_filters = []
+                if len(cells) > 1:
+                    row_filters.append(f"hstack=inputs={len(cells)}")
+                if len(cells) < grid_cols:
+                    row_filters.append(f"pad={grid_cols * tile_width}:{tile_height}:0:0:black")
+                row_label = '[outv]' if grid_rows == 1 else f"[row{row}]"
+                filter_parts.append(
+                    ''.join(f"[v{i}]" for i in cells) + ','.join(row_filters) + row_label
+                )
+                row_labels.append(row_label)
+            if grid_rows > 1:
+                filter_parts.append(f"{''.join(row_labels)}vstack=inputs={grid_rows}[outv]")
+            audio_inputs = ''.join(f"[a{i}]" for i in range(num_videos))
+            filter_parts.append(f"{audio_inputs}amix=inputs={num_videos}:duration=longest{contrib_audio}")
+        if master_audio_path:
+            filter_parts.append(f"{contrib_audio}[{num_videos}:a]amix=inputs=2:duration=longest[outa]")
+        filter_complex = ';'.join(filter_parts)
+
+        video_out = '[outv]'
+        if encoder == 'vaapi':
+            filter_complex += ';[outv]format=nv12,hwupload[outv_hw]'
+            video_out = '[outv_hw]'
+
+        print(f"[WORKER] ===== FILTER_COMPLEX =====")
+        print(filter_complex)
+        print(f"[WORKER] ===== END FILTER_COMPLEX =====")
+
+        output_path = os.path.join(work_dir, 'output_grid.mp4')
+
+        # Build FFmpeg command — offsets were already trimmed during pre-scale
+        ffmpeg_cmd = ['ffmpeg', '-y', '-hide_banner', '-nostats', '-progress', 'pipe:1', '-stats_period', '5']
+        if encoder == 'vaapi':
+            ffmpeg_cmd.extend(['-vaapi_device', VAAPI_DEVICE])
+        for video in video_files:
+            ffmpeg_cmd.extend([*RENDER_INPUT_ARGS, '-i', video['path']])
+        if master_audio_path:
+            ffmpeg_cmd.extend([*RENDER_INPUT_ARGS, '-i', master_audio_path])
+        ffmpeg_cmd.extend([
+            '-filter_complex_threads', str(CPU_COUNT),
+            '-filter_complex', filter_complex,
+            '-map', video_out,
+            '-map', '[outa]',
+            *VIDEO_ENCODER_ARGS[encoder],
+            '-maxrate', '2M',
+            '-bufsize', '4M',
+            '-c:a', 'aac',
+            '-b:a', '128k',
+            '-threads', '2',
+            '-max_muxing_queue_size', '1024',
+            output_path
+        ])
+
+        print(f"[WORKER] Running FFmpeg...")
+        if encoder == 'libx264':
+            returncode, stderr = await _run_monitored(ffmpeg_cmd, RENDER_TIMEOUT_SECONDS, RENDER_STALL_SECONDS)
+        else:
+            async with _gpu_encode_slots:
+                returncode, stderr = await _run_monitored(ffmpeg_cmd, RENDER_TIMEOUT_SECONDS, RENDER_STALL_SECONDS)
+        if returncode != 0:
+            print(f"[WORKER] FFmpeg error: {stderr}")
+            raise RuntimeError(f"FFmpeg failed: {stderr[-500:]}")
+        print(f"[WORKER] Video rendered successfully")
+
+        print(f"[WORKER] Uploading to Cloudinary...")
+        _configure_cloudinary()
+        # Chunked upload in a worker thread keeps memory bounded and the event loop free
+        upload_result = await asyncio.get_running_loop().run_in_executor(
+            None,
+            functools.partial(
+                cloudinary.uploader.upload_large,
+                output_path,
+                resource_type="video",
+                folder="choir_contributions",
+                chunk_size=UPLOAD_CHUNK_SIZE,
+                timeout=300
+            )
+        )
+        video_url = upload_result['secure_url']
+        print(f"[WORKER] Upload complete: {video_url}")
+
+        return {
+            "status": "success",
+            "job_id": job_id,
+            "output_video_url": video_url,
+            "video_url": video_url,
+            "clip_count": num_videos,
+            "grid_layout": f"{grid_rows}x{grid_cols}"
+        }
+
+    except Exception as e:
+        print(f"[WORKER] Error: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return {
+            "status": "error",
+            "job_id": job_id,
+            "error": str(e)
+        }
+    finally:
+        if work_dir and os.path.exists(work_dir):
+            print(f"[WORKER] Cleaning up {work_dir}")
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+@contextlib.asynccontextmanager
+async def _lifespan(app):
+    global _http_client
+    _http_client = httpx.AsyncClient(
+        http2=True,
+        # No pool-acquire timeout: every clip download of every job starts at
+        # once, and queueing for a connection slot must not fail a render
+        timeout=httpx.Timeout(60, pool=None),
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=16)
+    )
+    try:
+        yield
+    finally:
+        await _http_client.aclose()
+        _http_client = None
+
+
+async def _json_body(request: Request):
+    # Decode with orjson rather than FastAPI's stdlib json + dict validation
+    try:
+        payload = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        payload = None
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=422, detail="Request body must be a JSON object")
+    return payload
+
+
+def make_app(offset_impl=detect_offset):
+    app = FastAPI(lifespan=_lifespan, default_response_class=ORJSONResponse)
+    app.get("/")(health_check)
+
+    @app.post("/")
+    async def render_route(payload: dict = Depends(_json_body)):
+        return await choir_render_job(payload)
+
+    @app.post("/worker/offset")
+    async def offset_route(payload: dict = Depends(_json_body)):
+        return await offset_job(payload, offset_impl)
+
+    return app